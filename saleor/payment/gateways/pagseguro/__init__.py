@@ -1,24 +1,50 @@
-from typing import Dict, List, Optional
-
+import logging
+import operator
+from decimal import Decimal
+from functools import lru_cache, partial
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+from urllib.parse import urljoin
+from xml.etree import ElementTree
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import Promise
 from django.utils.translation import pgettext_lazy
 
 from ... import ChargeStatus, TransactionKind
-from ...interface import GatewayConfig, GatewayResponse, PaymentData
-
+from ...interface import (
+    CreditCardInfo,
+    CustomerSource,
+    GatewayConfig,
+    GatewayResponse,
+    PaymentData,
+    TokenConfig,
+)
 from .errors import DEFAULT_ERROR_MESSAGE, PagSeguroException
 from .forms import PagSeguroPaymentForm
-from saleor.settings import (
-    PAGSEGURO_ACCOUNT,
-    PAGSEGURO_TOKEN,
-    PAGSEGURO_SANDBOX,
-    PAGSEGURO_URL
-)
 
-SESSION_INIT = "https://ws.pagseguro.uol.com.br/email=%s&token=%s" % (
-    PAGSEGURO_ACCOUNT,
-    PAGSEGURO_TOKEN
-)
+try:
+    import pagseguro_sdk
+except ImportError:
+    pagseguro_sdk = None
+
+logger = logging.getLogger(__name__)
+
+SESSION_CACHE_KEY = "pagseguro_session_id_"
+# PagSeguro sessions are valid for 3 minutes, keep a safety margin
+SESSION_CACHE_TIME = 170
+TIMEOUT = 10  # API HTTP Requests Timeout
+
+# Maximum number of distinct PagSeguro credential sets kept in memory
+GATEWAY_CACHE_SIZE = 64
+
+# Tokens used by the payment form to simulate a given charge status
+_CHARGE_STATUS_TOKENS = frozenset(status for status, _ in ChargeStatus.CHOICES)
+
+# Refunds are answered locally until PagSeguro refunds are supported
+USE_DUMMY_REFUND = True
 
 # Error codes whitelist should be a dict of code: error_msg_override
 # if no error_msg_override is provided,
@@ -29,47 +55,115 @@ ERROR_CODES_WHITELIST = {
         Please try again later. Settlement time might vary depending
         on the issuers bank."""
 }
+_WHITELISTED_CODES = frozenset(ERROR_CODES_WHITELIST)
+
+# PagSeguro never requires an additional action from the customer
+_make_response = partial(GatewayResponse, action_required=False)
+
+DEFAULT_PAYMENT_ERROR = pgettext_lazy(
+    "payment error", "Unable to process transaction. Please try again in a moment"
+)
+
+
+# PagSeguro billing keys and the matching AddressData attributes
+_BILLING_KEYS = (
+    "first_name",
+    "last_name",
+    "company",
+    "postal_code",
+    "street_address",
+    "extended_address",
+    "locality",
+    "region",
+    "country_code_alpha2",
+)
+_get_billing_values = operator.attrgetter(
+    "first_name",
+    "last_name",
+    "company_name",
+    "postal_code",
+    "street_address_1",
+    "street_address_2",
+    "city",
+    "country_area",
+    "country",
+)
+
+# Keys of the locally stored gateway response for a PagSeguro transaction
+_TRANSACTION_RESPONSE_KEYS = (
+    "transaction_id",
+    "currency",
+    "amount",
+    "credit_card",
+    "customer_id",
+    "errors",
+)
+_get_transaction_values = operator.attrgetter(
+    "currency_iso_code", "amount", "credit_card", "customer_details"
+)
 
 
 def get_billing_data(payment_information: PaymentData) -> Dict:
-    billing = {}
-    if payment_information.billing:
-        billing_info = payment_information.billing
-        billing = {
-            "first_name": billing_info.first_name,
-            "last_name": billing_info.last_name,
-            "company": billing_info.company_name,
-            "postal_code": billing_info.postal_code,
-            "street_address": billing_info.street_address_1,
-            "extended_address": billing_info.street_address_2,
-            "locality": billing_info.city,
-            "region": billing_info.country_area,
-            "country_code_alpha2": billing_info.country,
-        }
-    return billing
+    if not payment_information.billing:
+        return {}
+    return dict(zip(_BILLING_KEYS, _get_billing_values(payment_information.billing)))
 
 
 def get_customer_data(payment_information: PaymentData) -> Dict:
     """Provide customer info, use only for new customer creation."""
-    return {
+    customer_data = {
         "order_id": payment_information.order_id,
-        "billing": get_billing_data(payment_information),
-        "risk_data": {"customer_ip": payment_information.customer_ip_address or ""},
         "customer": {"email": payment_information.customer_email},
     }
+    if payment_information.billing:
+        customer_data["billing"] = get_billing_data(payment_information)
+    if payment_information.customer_ip_address:
+        customer_data["risk_data"] = {
+            "customer_ip": payment_information.customer_ip_address
+        }
+    return customer_data
+
 
+@lru_cache(maxsize=1)
+def _render_default_payment_error() -> str:
+    return str(DEFAULT_PAYMENT_ERROR)
 
-def get_error_for_client(errors: List) -> str:
+
+def get_default_payment_error() -> Union[str, Promise]:
+    """Return the default client error, rendered once when translations are off."""
+    if settings.USE_I18N:
+        return DEFAULT_PAYMENT_ERROR
+    return _render_default_payment_error()
+
+
+def get_whitelisted_error(error: Dict) -> Optional[str]:
+    """Return the client message for a whitelisted error, None for other errors."""
+    code = error["code"]
+    if code not in _WHITELISTED_CODES:
+        return None
+    return ERROR_CODES_WHITELIST[code] or error["message"]
+
+
+def get_error_for_client(errors: List) -> Union[str, Promise]:
     """Filter all error messages and decides which one is visible for the client."""
     if not errors:
         return ""
-    default_msg = pgettext_lazy(
-        "payment error", "Unable to process transaction. Please try again in a moment"
-    )
     for error in errors:
-        if error["code"] in ERROR_CODES_WHITELIST:
-            return ERROR_CODES_WHITELIST[error["code"]] or error["message"]
-    return default_msg
+        client_error = get_whitelisted_error(error)
+        if client_error is not None:
+            return client_error
+    return get_default_payment_error()
+
+
+def merge_gateway_response(
+    gateway_response: Dict, payment_information: PaymentData
+) -> Tuple[Decimal, str, str]:
+    """Return amount, currency and transaction id, preferring the gateway values."""
+    return (
+        gateway_response.get("amount", payment_information.amount),
+        gateway_response.get("currency", payment_information.currency),
+        gateway_response.get("transaction_id", payment_information.token),
+    )
 
 
 def extract_gateway_response(pagseguro_result) -> Dict:
@@ -80,25 +174,134 @@ def extract_gateway_response(pagseguro_result) -> Dict:
             {"code": error.code, "message": error.message}
             for error in pagseguro_result.errors.deep_errors
         ]
-    bt_transaction = pagseguro_result.transaction
+    return _build_gateway_response(pagseguro_result.transaction, errors)
+
 
+def extract_gateway_response_and_error(
+    pagseguro_result
+) -> Tuple[Dict, Union[str, Promise]]:
+    """Extract the locally stored response and the client error in one pass.
+
+    The client error is picked with the same rule as in `get_error_for_client`.
+    """
+    errors = []
+    client_error = None
+    if not pagseguro_result.is_success:
+        for gateway_error in pagseguro_result.errors.deep_errors:
+            error = {"code": gateway_error.code, "message": gateway_error.message}
+            errors.append(error)
+            if client_error is None:
+                client_error = get_whitelisted_error(error)
+    if client_error is None:
+        client_error = get_default_payment_error() if errors else ""
+    gateway_response = _build_gateway_response(pagseguro_result.transaction, errors)
+    return gateway_response, client_error
+
+
+def _build_gateway_response(bt_transaction, errors: List) -> Dict:
     if not bt_transaction:
         return {"errors": errors}
-    return {
-        "transaction_id": getattr(bt_transaction, "id", ""),
-        "currency": bt_transaction.currency_iso_code,
-        "amount": bt_transaction.amount,  # Decimal type
-        "credit_card": bt_transaction.credit_card,
-        "customer_id": bt_transaction.customer_details.id,
-        "errors": errors,
-    }
+    try:
+        transaction_id = bt_transaction.id
+    except AttributeError:
+        transaction_id = ""
+    currency, amount, credit_card, customer_details = _get_transaction_values(
+        bt_transaction
+    )
+    return dict(
+        zip(
+            _TRANSACTION_RESPONSE_KEYS,
+            (
+                transaction_id,
+                currency,
+                amount,  # Decimal type
+                credit_card,
+                customer_details.id,
+                errors,
+            ),
+        )
+    )
+
+
+class PagSeguroSettings(NamedTuple):
+    account: str
+    token: str
+    sandbox_url: str
+    url: str
+
+
+@lru_cache(maxsize=None)
+def get_pagseguro_settings() -> PagSeguroSettings:
+    """Read the PagSeguro account settings once.
+
+    Call `get_pagseguro_settings.cache_clear()` after overriding them in tests.
+    """
+    return PagSeguroSettings(
+        account=settings.PAGSEGURO_ACCOUNT,
+        token=settings.PAGSEGURO_TOKEN,
+        sandbox_url=settings.PAGSEGURO_SANDBOX,
+        url=settings.PAGSEGURO_URL,
+    )
+
+
+def get_api_url(sandbox_mode: bool) -> str:
+    """Based on settings return sandbox or production url."""
+    pagseguro_settings = get_pagseguro_settings()
+    if sandbox_mode:
+        return pagseguro_settings.sandbox_url
+    return pagseguro_settings.url
+
+
+def get_session_url(sandbox_mode: bool) -> str:
+    # Sessions live next to the configured checkout endpoint, e.g. /v2/sessions
+    return urljoin(get_api_url(sandbox_mode), "sessions")
+
+
+def get_session_id(sandbox_mode: bool) -> Optional[str]:
+    """Return the PagSeguro session id, reused for as long as it is valid."""
+    pagseguro_settings = get_pagseguro_settings()
+    environment = "sandbox" if sandbox_mode else "production"
+    cache_key = "%s%s_%s" % (SESSION_CACHE_KEY, environment, pagseguro_settings.account)
+    session_id = cache.get(cache_key)
+    if session_id:
+        return session_id
+
+    params = {"email": pagseguro_settings.account, "token": pagseguro_settings.token}
+    try:
+        response = requests.post(
+            get_session_url(sandbox_mode), params=params, timeout=TIMEOUT
+        )
+        logger.debug("Hit to PagSeguro to create a %s session", environment)
+    except requests.exceptions.RequestException:
+        logger.warning("Failed to create PagSeguro session")
+        return None
+    if not response.ok:
+        logger.warning("Failed to create PagSeguro session: %s", response.status_code)
+        return None
+
+    try:
+        session_id = ElementTree.fromstring(response.content).findtext("id")
+    except ElementTree.ParseError:
+        logger.warning("Unable to parse PagSeguro session response")
+        return None
+    if session_id:
+        cache.set(cache_key, session_id, SESSION_CACHE_TIME)
+    return session_id
 
 
 def create_form(data, payment_information):
     return PagSeguroPaymentForm(data=data, payment_information=payment_information)
 
 
+@lru_cache(maxsize=GATEWAY_CACHE_SIZE)
 def get_pagseguro_gateway(sandbox_mode, merchant_id, public_key, private_key):
+    """Return a gateway for the given credentials, reused between calls.
+
+    Gateways are cached per credentials set, so the SDK client (and the HTTP
+    connections it keeps alive) is shared instead of being rebuilt per call.
+    """
+    if pagseguro_sdk is None:
+        raise ImproperlyConfigured("PagSeguro SDK is not installed.")
     if not all([merchant_id, private_key, public_key]):
         raise ImproperlyConfigured("Incorrectly configured PagSeguro gateway.")
     environment = pagseguro_sdk.Environment.Sandbox
@@ -134,38 +337,44 @@ def create_token_params(config: GatewayConfig, token_config: TokenConfig) -> dic
 
 
 def authorize(
-    payment_information: PaymentData, config: GatewayConfig
+    payment_information: PaymentData, config: GatewayConfig, gateway=None
 ) -> GatewayResponse:
+    if gateway is None:
+        gateway = get_pagseguro_gateway(**config.connection_params)
     try:
         if not payment_information.customer_id:
-            result = transaction_for_new_customer(payment_information, config)
+            result = transaction_for_new_customer(
+                payment_information, config, gateway=gateway
+            )
         else:
-            result = transaction_for_existing_customer(payment_information, config)
+            result = transaction_for_existing_customer(
+                payment_information, config, gateway=gateway
+            )
     except pagseguro_sdk.exceptions.NotFoundError:
         raise PagSeguroException(DEFAULT_ERROR_MESSAGE)
 
-    gateway_response = extract_gateway_response(result)
-    error = get_error_for_client(gateway_response["errors"])
+    gateway_response, error = extract_gateway_response_and_error(result)
+    amount, currency, transaction_id = merge_gateway_response(
+        gateway_response, payment_information
+    )
     kind = TransactionKind.CAPTURE if config.auto_capture else TransactionKind.AUTH
-    return GatewayResponse(
+    return _make_response(
         is_success=result.is_success,
-        action_required=False,
         kind=kind,
-        amount=gateway_response.get("amount", payment_information.amount),
-        currency=gateway_response.get("currency", payment_information.currency),
+        amount=amount,
+        currency=currency,
         customer_id=gateway_response.get("customer_id"),
-        transaction_id=gateway_response.get(
-            "transaction_id", payment_information.token
-        ),
+        transaction_id=transaction_id,
         error=error,
         raw_response=gateway_response,
     )
 
 
 def transaction_for_new_customer(
-    payment_information: PaymentData, config: GatewayConfig
+    payment_information: PaymentData, config: GatewayConfig, gateway=None
 ):
-    gateway = get_pagseguro_gateway(**config.connection_params)
+    if gateway is None:
+        gateway = get_pagseguro_gateway(**config.connection_params)
     return gateway.transaction.sale(
         {
             "amount": str(payment_information.amount),
@@ -181,9 +390,10 @@ def transaction_for_new_customer(
 
 
 def transaction_for_existing_customer(
-    payment_information: PaymentData, config: GatewayConfig
+    payment_information: PaymentData, config: GatewayConfig, gateway=None
 ):
-    gateway = get_pagseguro_gateway(**config.connection_params)
+    if gateway is None:
+        gateway = get_pagseguro_gateway(**config.connection_params)
     return gateway.transaction.sale(
         {
             "amount": str(payment_information.amount),
@@ -194,8 +404,11 @@ def transaction_for_existing_customer(
     )
 
 
-def capture(payment_information: PaymentData, config: GatewayConfig) -> GatewayResponse:
-    gateway = get_pagseguro_gateway(**config.connection_params)
+def capture(
+    payment_information: PaymentData, config: GatewayConfig, gateway=None
+) -> GatewayResponse:
+    if gateway is None:
+        gateway = get_pagseguro_gateway(**config.connection_params)
 
     try:
         result = gateway.transaction.submit_for_settlement(
@@ -205,18 +418,17 @@ def capture(payment_information: PaymentData, config: GatewayConfig) -> GatewayR
     except pagseguro_sdk.exceptions.NotFoundError:
         raise PagSeguroException(DEFAULT_ERROR_MESSAGE)
 
-    gateway_response = extract_gateway_response(result)
-    error = get_error_for_client(gateway_response["errors"])
+    gateway_response, error = extract_gateway_response_and_error(result)
+    amount, currency, transaction_id = merge_gateway_response(
+        gateway_response, payment_information
+    )
 
-    return GatewayResponse(
+    return _make_response(
         is_success=result.is_success,
-        action_required=False,
         kind=TransactionKind.CAPTURE,
-        amount=gateway_response.get("amount", payment_information.amount),
-        currency=gateway_response.get("currency", payment_information.currency),
-        transaction_id=gateway_response.get(
-            "transaction_id", payment_information.token
-        ),
+        amount=amount,
+        currency=currency,
+        transaction_id=transaction_id,
         error=error,
         raw_response=gateway_response,
     )
@@ -230,27 +442,37 @@ def void(payment_information: PaymentData, config: GatewayConfig) -> GatewayResp
     except pagseguro_sdk.exceptions.NotFoundError:
         raise PagSeguroException(DEFAULT_ERROR_MESSAGE)
 
-    gateway_response = extract_gateway_response(result)
-    error = get_error_for_client(gateway_response["errors"])
+    gateway_response, error = extract_gateway_response_and_error(result)
+    amount, currency, transaction_id = merge_gateway_response(
+        gateway_response, payment_information
+    )
 
-    return GatewayResponse(
+    return _make_response(
         is_success=result.is_success,
-        action_required=False,
         kind=TransactionKind.VOID,
-        amount=gateway_response.get("amount", payment_information.amount),
-        currency=gateway_response.get("currency", payment_information.currency),
-        transaction_id=gateway_response.get(
-            "transaction_id", payment_information.token
-        ),
+        amount=amount,
+        currency=currency,
+        transaction_id=transaction_id,
         error=error,
         raw_response=gateway_response,
     )
 
 
-def refund(
-        payment_information: PaymentData,
-        config: GatewayConfig
-) -> GatewayResponse:
+def refund(payment_information: PaymentData, config: GatewayConfig) -> GatewayResponse:
+    if USE_DUMMY_REFUND:
+        error = None
+        success = dummy_success()
+        if not success:
+            error = "Unable to process refund"
+        return _make_response(
+            is_success=success,
+            kind=TransactionKind.REFUND,
+            amount=payment_information.amount,
+            currency=payment_information.currency,
+            transaction_id=payment_information.token,
+            error=error,
+        )
+
     gateway = get_pagseguro_gateway(**config.connection_params)
 
     try:
@@ -261,32 +483,17 @@ def refund(
     except pagseguro_sdk.exceptions.NotFoundError:
         raise PagSeguroException(DEFAULT_ERROR_MESSAGE)
 
-    error = None
-    success = dummy_success()
-    if not success:
-        error = "Unable to process refund"
-    return GatewayResponse(
-        is_success=success,
-        action_required=False,
-        kind=TransactionKind.REFUND,
-        amount=payment_information.amount,
-        currency=payment_information.currency,
-        transaction_id=payment_information.token,
-        error=error,
+    gateway_response, error = extract_gateway_response_and_error(result)
+    amount, currency, transaction_id = merge_gateway_response(
+        gateway_response, payment_information
     )
 
-    gateway_response = extract_gateway_response(result)
-    error = get_error_for_client(gateway_response["errors"])
-
-    return GatewayResponse(
+    return _make_response(
         is_success=result.is_success,
-        action_required=False,
         kind=TransactionKind.REFUND,
-        amount=gateway_response.get("amount", payment_information.amount),
-        currency=gateway_response.get("currency", payment_information.currency),
-        transaction_id=gateway_response.get(
-            "transaction_id", payment_information.token
-        ),
+        amount=amount,
+        currency=currency,
+        transaction_id=transaction_id,
         error=error,
         raw_response=gateway_response,
     )
@@ -297,22 +504,24 @@ def process_payment(
 ) -> GatewayResponse:
     """Process the payment."""
     token = payment_information.token
+    gateway = get_pagseguro_gateway(**config.connection_params)
 
     # Process payment normally if payment token is valid
-    if token not in dict(ChargeStatus.CHOICES):
-        return capture(payment_information, config)
+    if token not in _CHARGE_STATUS_TOKENS:
+        return capture(payment_information, config, gateway=gateway)
 
-    # Process payment by charge status which is selected in the payment form
-    # Note that is for testing by dummy gateway only
+    # Process payment by charge status which is selected in the payment form.
+    # Authorization and capture go through the configured PagSeguro gateway,
+    # only the refund step is answered locally while USE_DUMMY_REFUND is set.
     charge_status = token
-    authorize_response = authorize(payment_information, config)
+    authorize_response = authorize(payment_information, config, gateway=gateway)
     if charge_status == ChargeStatus.NOT_CHARGED:
         return authorize_response
 
     if not config.auto_capture:
         return authorize_response
 
-    capture_response = capture(payment_information, config)
+    capture_response = capture(payment_information, config, gateway=gateway)
     if charge_status == ChargeStatus.FULLY_REFUNDED:
         return refund(payment_information, config)
     return capture_response
@@ -343,70 +552,11 @@ def extract_credit_card_data(card, gateway_name):
         credit_card_info=credit_card,
     )
 
+
 def dummy_success():
     return True
 
 
-def get_client_token(**_):
-    return str(uuid.uuid4())
-
-
-def create_form(data, payment_information, connection_params):
-    return DummyPaymentForm(data=data)
-
-
-def authorize(
-    payment_information: PaymentData, config: GatewayConfig
-) -> GatewayResponse:
-    success = dummy_success()
-    error = None
-    if not success:
-        error = "Unable to authorize transaction"
-    return GatewayResponse(
-        is_success=success,
-        action_required=False,
-        kind=TransactionKind.AUTH,
-        amount=payment_information.amount,
-        currency=payment_information.currency,
-        transaction_id=payment_information.token,
-        error=error,
-    )
-
-
-def void(payment_information: PaymentData, config: GatewayConfig) -> GatewayResponse:
-    error = None
-    success = dummy_success()
-    if not success:
-        error = "Unable to void the transaction."
-    return GatewayResponse(
-        is_success=success,
-        action_required=False,
-        kind=TransactionKind.VOID,
-        amount=payment_information.amount,
-        currency=payment_information.currency,
-        transaction_id=payment_information.token,
-        error=error,
-    )
-
-
-def capture(payment_information: PaymentData, config: GatewayConfig) -> GatewayResponse:
-    """Perform capture transaction."""
-    error = None
-    success = dummy_success()
-    if not success:
-        error = "Unable to process capture"
-
-    return GatewayResponse(
-        is_success=success,
-        action_required=False,
-        kind=TransactionKind.CAPTURE,
-        amount=payment_information.amount,
-        currency=payment_information.currency,
-        transaction_id=payment_information.token,
-        error=error,
-    )
-
-
 def confirm(payment_information: PaymentData, config: GatewayConfig) -> GatewayResponse:
     """Perform confirm transaction."""
     error = None
@@ -414,9 +564,8 @@ def confirm(payment_information: PaymentData, config: GatewayConfig) -> GatewayR
     if not success:
         error = "Unable to process capture"
 
-    return GatewayResponse(
+    return _make_response(
         is_success=success,
-        action_required=False,
         kind=TransactionKind.CAPTURE,
         amount=payment_information.amount,
         currency=payment_information.currency,
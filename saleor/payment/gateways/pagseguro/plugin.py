@@ -20,7 +20,7 @@ from . import (
 GATEWAY_NAME = "PagSeguro"
 
 if TYPE_CHECKING:
-    from . import GatewayResponse, PaymentData, TokenConfig
+    from . import CustomerSource, GatewayResponse, PaymentData, TokenConfig
     from django import forms
 
 
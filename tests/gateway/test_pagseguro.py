@@ -0,0 +1,257 @@
+from decimal import Decimal
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+from django.core.cache import cache
+from django.utils.functional import Promise
+
+from saleor.payment.gateways.pagseguro import (
+    extract_gateway_response,
+    extract_gateway_response_and_error,
+    get_client_token,
+    get_default_payment_error,
+    get_error_for_client,
+    get_pagseguro_settings,
+    get_session_id,
+)
+from saleor.payment.interface import GatewayConfig, TokenConfig
+
+DEFAULT_ERROR = "Unable to process transaction. Please try again in a moment"
+SESSION_RESPONSE = b"<?xml version='1.0'?><session><id>session-id</id></session>"
+
+
+@pytest.fixture(autouse=True)
+def pagseguro_settings(settings):
+    settings.PAGSEGURO_ACCOUNT = "merchant+shop@example.com"
+    settings.PAGSEGURO_TOKEN = "secret-token"
+    settings.PAGSEGURO_URL = "https://ws.pagseguro.uol.com.br/v2/checkout"
+    settings.PAGSEGURO_SANDBOX = "https://ws.sandbox.pagseguro.uol.com.br/v2/checkout"
+    get_pagseguro_settings.cache_clear()
+    cache.clear()
+    yield settings
+    get_pagseguro_settings.cache_clear()
+    cache.clear()
+
+
+@pytest.fixture
+def pagseguro_success_response():
+    return Mock(
+        is_success=True,
+        transaction=Mock(
+            id="1x02131",
+            amount=Decimal("80.00"),
+            credit_card="",
+            customer_details=Mock(id=None),
+            currency_iso_code="BRL",
+        ),
+    )
+
+
+@pytest.fixture
+def pagseguro_error():
+    return Mock(code="91506", message="Cannot refund transaction unless it is settled.")
+
+
+@pytest.fixture
+def pagseguro_error_response(pagseguro_error):
+    return Mock(
+        is_success=False, transaction=None, errors=Mock(deep_errors=[pagseguro_error])
+    )
+
+
+@pytest.fixture
+def gateway_config():
+    return GatewayConfig(
+        gateway_name="pagseguro",
+        template_path="template.html",
+        auto_capture=False,
+        store_customer=False,
+        connection_params={
+            "sandbox_mode": True,
+            "merchant_id": "123",
+            "public_key": "456",
+            "private_key": "789",
+        },
+    )
+
+
+@patch("saleor.payment.gateways.pagseguro.requests.post")
+def test_get_session_id(mock_post):
+    mock_post.return_value = Mock(ok=True, status_code=200, content=SESSION_RESPONSE)
+
+    assert get_session_id(sandbox_mode=True) == "session-id"
+    mock_post.assert_called_once_with(
+        "https://ws.sandbox.pagseguro.uol.com.br/v2/sessions",
+        params={"email": "merchant+shop@example.com", "token": "secret-token"},
+        timeout=10,
+    )
+
+
+@patch("saleor.payment.gateways.pagseguro.requests.post")
+def test_get_session_id_is_cached(mock_post):
+    mock_post.return_value = Mock(ok=True, status_code=200, content=SESSION_RESPONSE)
+
+    get_session_id(sandbox_mode=False)
+    assert get_session_id(sandbox_mode=False) == "session-id"
+    mock_post.assert_called_once()
+    assert mock_post.call_args[0][0] == "https://ws.pagseguro.uol.com.br/v2/sessions"
+
+
+@patch("saleor.payment.gateways.pagseguro.requests.post")
+def test_get_session_id_is_cached_per_environment(mock_post):
+    mock_post.return_value = Mock(ok=True, status_code=200, content=SESSION_RESPONSE)
+
+    get_session_id(sandbox_mode=False)
+    get_session_id(sandbox_mode=True)
+    assert mock_post.call_count == 2
+
+
+@patch("saleor.payment.gateways.pagseguro.requests.post")
+def test_get_session_id_request_error(mock_post):
+    mock_post.side_effect = requests.exceptions.ConnectionError()
+
+    assert get_session_id(sandbox_mode=True) is None
+
+
+@patch("saleor.payment.gateways.pagseguro.requests.post")
+def test_get_session_id_rejected(mock_post):
+    mock_post.return_value = Mock(ok=False, status_code=401, content=b"Unauthorized")
+
+    assert get_session_id(sandbox_mode=True) is None
+    assert get_session_id(sandbox_mode=True) is None
+    assert mock_post.call_count == 2
+
+
+@patch("saleor.payment.gateways.pagseguro.requests.post")
+def test_get_session_id_malformed_response(mock_post):
+    mock_post.return_value = Mock(ok=True, status_code=200, content=b"<session>")
+
+    assert get_session_id(sandbox_mode=True) is None
+
+
+@patch("saleor.payment.gateways.pagseguro.get_pagseguro_gateway")
+def test_get_client_token(mock_gateway, gateway_config):
+    expected_token = "client-token"
+    mock_generate = Mock(return_value=expected_token)
+    mock_gateway.return_value = Mock(client_token=Mock(generate=mock_generate))
+    token = get_client_token(gateway_config)
+    mock_gateway.assert_called_once_with(**gateway_config.connection_params)
+    mock_generate.assert_called_once_with()
+    assert token == expected_token
+
+
+@patch("saleor.payment.gateways.pagseguro.get_pagseguro_gateway")
+def test_get_client_token_with_customer_id(mock_gateway, gateway_config):
+    gateway_config.store_customer = True
+    mock_generate = Mock(return_value="client-token")
+    mock_gateway.return_value = Mock(client_token=Mock(generate=mock_generate))
+    get_client_token(gateway_config, TokenConfig(customer_id="1234"))
+    mock_generate.assert_called_once_with({"customer_id": "1234"})
+
+
+def test_get_error_for_client(monkeypatch):
+    # no error
+    assert get_error_for_client([]) == ""
+
+    error = {"code": "91507", "message": "Cannot submit for settlement."}
+
+    # error not whitelisted
+    assert get_error_for_client([error]) == DEFAULT_ERROR
+
+    monkeypatch.setattr(
+        "saleor.payment.gateways.pagseguro.ERROR_CODES_WHITELIST", {"91507": ""}
+    )
+    monkeypatch.setattr(
+        "saleor.payment.gateways.pagseguro._WHITELISTED_CODES", frozenset(["91507"])
+    )
+    assert get_error_for_client([error]) == error["message"]
+
+
+def test_get_error_for_client_returns_first_whitelisted_error(monkeypatch):
+    whitelist = {code: "" for code in ("91501", "91502", "91503", "91504")}
+    monkeypatch.setattr(
+        "saleor.payment.gateways.pagseguro.ERROR_CODES_WHITELIST", whitelist
+    )
+    monkeypatch.setattr(
+        "saleor.payment.gateways.pagseguro._WHITELISTED_CODES", frozenset(whitelist)
+    )
+    errors = [
+        {"code": "81709", "message": "Not whitelisted"},
+        {"code": "91503", "message": "First"},
+        {"code": "91501", "message": "Second"},
+        {"code": "91503", "message": "Third"},
+    ]
+    assert get_error_for_client(errors) == "First"
+
+
+def test_extract_gateway_response(pagseguro_success_response):
+    result = extract_gateway_response(pagseguro_success_response)
+    t = pagseguro_success_response.transaction
+    expected_result = {
+        "currency": t.currency_iso_code,
+        "amount": t.amount,
+        "credit_card": t.credit_card,
+        "errors": [],
+        "transaction_id": t.id,
+        "customer_id": None,
+    }
+    assert result == expected_result
+
+
+def test_extract_gateway_response_no_transaction(
+    pagseguro_error_response, pagseguro_error
+):
+    result = extract_gateway_response(pagseguro_error_response)
+    assert result == {
+        "errors": [{"code": pagseguro_error.code, "message": pagseguro_error.message}]
+    }
+
+
+def test_extract_gateway_response_and_error(pagseguro_error_response):
+    gateway_response, error = extract_gateway_response_and_error(
+        pagseguro_error_response
+    )
+    assert gateway_response == extract_gateway_response(pagseguro_error_response)
+    assert error == get_error_for_client(gateway_response["errors"])
+    assert "Cannot refund transaction unless it is settled." in error
+
+
+def test_extract_gateway_response_and_error_first_whitelisted(monkeypatch):
+    whitelist = {code: "" for code in ("91501", "91502")}
+    monkeypatch.setattr(
+        "saleor.payment.gateways.pagseguro.ERROR_CODES_WHITELIST", whitelist
+    )
+    monkeypatch.setattr(
+        "saleor.payment.gateways.pagseguro._WHITELISTED_CODES", frozenset(whitelist)
+    )
+    deep_errors = [
+        Mock(code="81709", message="Not whitelisted"),
+        Mock(code="91502", message="First"),
+        Mock(code="91501", message="Second"),
+    ]
+    result = Mock(
+        is_success=False, transaction=None, errors=Mock(deep_errors=deep_errors)
+    )
+    gateway_response, error = extract_gateway_response_and_error(result)
+    assert error == "First"
+    assert error == get_error_for_client(gateway_response["errors"])
+    assert len(gateway_response["errors"]) == 3
+
+
+def test_extract_gateway_response_and_error_success(pagseguro_success_response):
+    _, error = extract_gateway_response_and_error(pagseguro_success_response)
+    assert error == ""
+
+
+def test_get_default_payment_error_follows_use_i18n(settings):
+    settings.USE_I18N = True
+    assert isinstance(get_default_payment_error(), Promise)
+
+    settings.USE_I18N = False
+    error = get_default_payment_error()
+    assert type(error) is str
+    assert error == DEFAULT_ERROR
+
+    settings.USE_I18N = True
+    assert isinstance(get_default_payment_error(), Promise)